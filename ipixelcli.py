@@ -87,6 +87,9 @@ async def handle_websocket(websocket, address):
                                 keyword_args[key.replace('-', '_')] = value
                             else:
                                 positional_args.append(param)
+                        # Keyword arguments may also come as a flat "opts" object
+                        for key, value in command_data.get("opts", {}).items():
+                            keyword_args[key.replace('-', '_')] = str(value)
 
                         # Generate the data to send
                         data = COMMANDS[command_name](*positional_args, **keyword_args)
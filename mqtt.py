@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 import os
-import json
 import time
+import logging
+import queue
+import shlex
+import signal
+import socket
+import ssl
 import threading
 import subprocess
+from types import MappingProxyType
+import orjson
 import websocket
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
@@ -20,6 +27,15 @@ SSL_ENABLED = os.getenv("SSL_ENABLED", "False").lower() == "true"
 DEVICE_MAC = os.getenv("DEVICE_MAC")
 IPIXELCLI = os.getenv("IPIXELCLI","python ./ipixelcli.py")
 WS_PORT =  os.getenv("WS_PORT","8765");
+# 0 = warnings only, 1 = info (default), 2 = debug (every message)
+LOG_LEVEL = int(os.getenv("LOG_LEVEL", "1"))
+
+logging.basicConfig(
+    level=logging.DEBUG if LOG_LEVEL >= 2 else logging.INFO if LOG_LEVEL == 1 else logging.WARNING,
+    format="%(asctime)s %(levelname)s %(message)s",
+)
+log = logging.getLogger(__name__)
+DEBUG_WS_RX = LOG_LEVEL >= 2
 
 
 
@@ -34,6 +50,9 @@ CMD_TOPIC = BASE_TOPIC + "/set"
 STATE_TOPIC = BASE_TOPIC + "/state"
 LAST_TEXT_TOPIC = BASE_TOPIC + "/last_text"
 WS_URL = f"ws://127.0.0.1:{WS_PORT}"
+SEND_COALESCE_WINDOW = 0.02  # seconds to collect queued sends before flushing
+WS_RETRY_MIN = 1   # seconds before retrying a failed WebSocket connect
+WS_RETRY_MAX = 30
 
 TOPICS = {
     "power": f"{BASE_TOPIC}/power",
@@ -50,6 +69,13 @@ TOPICS = {
     "clear": f"{BASE_TOPIC}/clear",
 }
 
+# Lookup tables for on_message, built once instead of per message. Topics stay
+# str: paho calls topic.encode() itself in publish/subscribe and rejects bytes.
+SET_TOPIC_MAP = {t + "/set": k for k, t in TOPICS.items()}
+SEND_TEXT_TOPIC = TOPICS["send_text"]
+CMD_TOPIC_PREFIX = CMD_TOPIC + "/"
+CMD_TOPIC_PREFIX_LEN = len(CMD_TOPIC_PREFIX)
+
 DEFAULTS = {
     "power": False,
     "brightness": 80,
@@ -63,86 +89,194 @@ DEFAULTS = {
     "font_offset_y": 0,
 }
 
+# State keys forwarded to the LED server as send_text "opts"
+_PARAM_KEYS = ("color", "speed", "animation", "font", "matrix_height")
+
+# Copy-on-write device state: d is a read-only snapshot that writers (the MQTT
+# callback thread) replace in a single attribute store, so readers can take
+# snap = state.d without a lock
+class _State:
+    __slots__ = ("d",)
+
+    def __init__(self, d):
+        self.d = MappingProxyType(dict(d))
+
+    def update(self, changes):
+        nd = dict(self.d)
+        nd.update(changes)
+        self.d = MappingProxyType(nd)
 
-current_states = DEFAULTS.copy()
+state = _State(DEFAULTS)
 last_text = ""
 ws = None
 client = None
+_server_proc = None
+_server_lock = threading.Lock()
+_stop = threading.Event()
+# Outbound WebSocket messages, drained by _ws_sender_loop
+_send_q = queue.SimpleQueue()
+_ws_lock = threading.Lock()
+_ws_next_retry = 0.0
+_ws_backoff = WS_RETRY_MIN
+
+# Last published snapshot, used to skip unchanged publish cycles
+_last_states = {}
+_last_state_blob = b""
+_last_published_text = None
 
 # -----------------------------
 # WebSocket helpers
 # -----------------------------
 def start_server_once():
-    cmd = f"{IPIXELCLI} -a {DEVICE_MAC} --host 127.0.0.1 --server -p 8765 &"
-    subprocess.Popen(cmd, shell=True)
-    time.sleep(2)
+    global _server_proc
+    argv = shlex.split(IPIXELCLI) + ["-a", DEVICE_MAC, "--host", "127.0.0.1", "--server", "-p", str(WS_PORT)]
+    # Own session so a terminal Ctrl-C doesn't hit the server before we stop it
+    # (see stop_server); stderr stays inherited so BLE errors remain visible
+    _server_proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                    start_new_session=True)
+    # Wait until the server accepts connections instead of a fixed sleep
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", int(WS_PORT)), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
 
-def ws_connect():
-    global ws
-    if ws:
+def stop_server():
+    # The server runs in its own session, so it won't die with us on its own
+    if _server_proc is None or _server_proc.poll() is not None:
+        return
+    _server_proc.terminate()
+    try:
+        _server_proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        _server_proc.kill()
+        _server_proc.wait()
+
+def _set_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Fine-grained knobs are Linux-only
+    for opt, val in (("TCP_KEEPIDLE", 15), ("TCP_KEEPINTVL", 5), ("TCP_KEEPCNT", 3)):
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), val)
+
+def ws_connect(force=False):
+    global ws, _ws_next_retry, _ws_backoff
+    with _ws_lock:
+        # Liveness is left to TCP keepalive; dead sockets surface as send errors
+        if ws:
+            return ws
+        # Server known to be down: fail fast until the backoff expires
+        if not force and time.monotonic() < _ws_next_retry:
+            return None
         try:
-            ws.send(json.dumps({"command": "ping"}))
+            conn = websocket.WebSocket()
+            conn.connect(WS_URL, timeout=5)
+            _set_keepalive(conn.sock)
+            # Block in recv until data arrives; keepalive catches dead peers
+            conn.settimeout(None)
+            ws = conn
+            _ws_backoff = WS_RETRY_MIN
+            _ws_next_retry = 0.0
+            log.info("[WS] Connected")
             return ws
-        except Exception:
-            try:
-                ws.close()
-            except:
-                pass
+        except Exception as e:
+            log.warning("[WS] Connect failed: %s (retry in %ss)", e, _ws_backoff)
+            _ws_next_retry = time.monotonic() + _ws_backoff
+            _ws_backoff = min(_ws_backoff * 2, WS_RETRY_MAX)
+            return None
+
+def _ws_drop(conn):
+    global ws
+    with _ws_lock:
+        if ws is conn:
             ws = None
     try:
-        ws = websocket.WebSocket()
-        ws.connect(WS_URL, timeout=5)
-        print("[WS] Connected")
-        threading.Thread(target=ws_receive_thread, daemon=True).start()
-        return ws
-    except Exception as e:
-        print("[WS] Connect failed:", e)
-        ws = None
-        return None
+        conn.close()
+    except:
+        pass
 
 def ensure_server():
-    if not ws_connect():
-        start_server_once()
-        ws_connect()
+    if ws_connect():
+        return
+    # Only spawn a new server if ours never started or has exited; the lock
+    # keeps the MQTT callback and periodic threads from both spawning one
+    with _server_lock:
+        if _server_proc is None or _server_proc.poll() is not None:
+            start_server_once()
+            ws_connect(force=True)
 
 def ws_send(payload):
-    global ws
-    try:
-        if not ws:
-            ws_connect()
-        if not ws:
-            print("[WS] Cannot send, no connection")
+    # Queue for the sender thread so the MQTT callback never blocks on the socket
+    _send_q.put((payload, orjson.dumps(payload)))
+
+def _ws_write(payload, buf):
+    for attempt in range(2):
+        conn = ws or ws_connect()
+        if not conn:
+            log.warning("[WS] Cannot send, no connection")
             return
-        ws.send(json.dumps(payload))
+        try:
+            conn.send(buf)
+        except Exception as e:
+            log.warning("[WS] Send failed: %s", e)
+            _ws_drop(conn)
+            continue
         cmd = payload.get("command")
         if cmd == "send_text":
-            print(f"[WS] Sent text: {payload['params'][0]}")
+            log.debug("[WS] Sent text: %s", payload["params"][0])
         else:
-            print(f"[WS] Sent command: {cmd} | params: {payload.get('params')}")
-    except Exception as e:
-        print("[WS] Send failed:", e)
+            log.debug("[WS] Sent command: %s | params: %s", cmd, payload.get("params"))
+        return
+
+def _ws_sender_loop():
+    while True:
+        batch = [_send_q.get()]
+        # Give rapid-fire updates a moment to pile up, then drain them
+        time.sleep(SEND_COALESCE_WINDOW)
+        while True:
+            try:
+                item = _send_q.get_nowait()
+            except queue.Empty:
+                break
+            # A newer send_text replaces one still waiting right before it;
+            # anything in between (clear, led_off, ...) keeps its order
+            if (item[0].get("command") == "send_text"
+                    and batch[-1][0].get("command") == "send_text"):
+                batch[-1] = item
+            else:
+                batch.append(item)
+        for payload, buf in batch:
+            _ws_write(payload, buf)
 
 def ws_receive_thread():
-    global ws
+    backoff = 0.5
     while True:
-        if not ws:
-            time.sleep(1)
+        conn = ws_connect()
+        if not conn:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10)
             continue
         try:
-            ws.settimeout(1)
-            msg = ws.recv()
-            if isinstance(msg, bytes):
-                continue
-            try:
-                data = json.loads(msg)
-                print("[WS] Received JSON:", data)
-            except Exception:
-                continue
-        except websocket.WebSocketTimeoutException:
-            continue
+            msg = conn.recv()
         except Exception as e:
-            print("[WS] Receive loop ended:", e)
-            time.sleep(2)
+            log.warning("[WS] Receive loop ended: %s", e)
+            _ws_drop(conn)
+            # The server may accept and then drop us right away (e.g. BLE
+            # connect failing), so back off here too
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10)
+            continue
+        backoff = 0.5
+        # Server replies are only acks; parse them just for debug output
+        if not DEBUG_WS_RX or isinstance(msg, (bytes, bytearray)):
+            continue
+        try:
+            data = orjson.loads(msg)
+            log.debug("[WS] Received JSON: %s", data)
+        except Exception:
+            continue
 
 # -----------------------------
 # LED helpers
@@ -150,11 +284,8 @@ def ws_receive_thread():
 def send_text_to_led(text, **kwargs):
     if not text:
         return
-    payload = {"command": "send_text", "params": [text]}
-    for k in ["color", "speed", "animation", "font", "matrix_height"]:
-        if k in kwargs and kwargs[k] is not None:
-            payload["params"].append(f"{k}={kwargs[k]}")
-    ws_send(payload)
+    opts = {k: kwargs[k] for k in _PARAM_KEYS if kwargs.get(k) is not None}
+    ws_send({"command": "send_text", "params": [text], "opts": opts})
 
 def clear_generated_texts():
     ws_send({"command": "clear", "params": []})
@@ -167,172 +298,210 @@ def send_led_on():
 # -----------------------------
 # MQTT helpers
 # -----------------------------
-def publish_states():
-    for k, v in current_states.items():
-        t = TOPICS.get(k)
-        if t:
-            client.publish(f"{t}/state", str(v), retain=True)
-    client.publish(STATE_TOPIC, json.dumps(current_states), retain=True)
-    client.publish(LAST_TEXT_TOPIC, last_text, retain=True)
-
-def handle_set_payload(key, payload):
+def publish_states(force=False):
+    global _last_states, _last_state_blob, _last_published_text
+    states = state.d
+    text = last_text
+    if not force and states == _last_states and text == _last_published_text:
+        return
+    # All values live in one retained JSON snapshot; HA reads them via value_json
+    if force or states != _last_states or not _last_state_blob:
+        _last_state_blob = orjson.dumps(dict(states))
+        client.publish(STATE_TOPIC, _last_state_blob, retain=True, qos=0)
+    if force or text != _last_published_text:
+        client.publish(LAST_TEXT_TOPIC, text, retain=True, qos=0)
+    _last_states = states
+    _last_published_text = text
+
+# Handlers for WebSocket-style {"command": ..., "params": [...]} objects
+def _h_led_on(data):
+    send_led_on()
+    log.info("[MQTT] Display turned ON")
+
+def _h_led_off(data):
+    send_led_off()
+    log.info("[MQTT] Display turned OFF")
+
+def _h_send_text(data):
     global last_text
-    payload = payload.decode() if isinstance(payload, bytes) else str(payload)
-    print(f"[MQTT] Set {key} -> {payload}")
+    if not data["params"]:
+        return
+    # Extract text from params
+    text_param = data["params"][0]
+    if text_param.startswith("text="):
+        last_text = text_param[5:]  # Remove "text=" prefix
+    else:
+        last_text = text_param
+    
+    log.debug("[MQTT] Extracted text: %s", last_text)
+    
+    # Send the command directly to WebSocket
+    ensure_server()
+    ws_send(data)  # Send the exact WebSocket command
 
-    try:
-        data = json.loads(payload)
-    except Exception:
-        data = payload
+_CMD_HANDLERS = {
+    "led_on": _h_led_on,
+    "led_off": _h_led_off,
+    "send_text": _h_send_text,
+}
 
+# Handlers per topic key
+def _h_set_json(key, data):
+    global last_text
     # Handle JSON object sent to base command topic
-    if key == "set" and isinstance(data, dict):
-        print(f"[MQTT] Processing JSON command: {data}")
+    if not isinstance(data, dict):
+        return
+    log.debug("[MQTT] Processing JSON command: %s", data)
+    
+    # Format 1: Direct WebSocket command (command/params structure)
+    if "command" in data and "params" in data:
+        log.debug("[MQTT] Detected WebSocket command format: %s", data["command"])
+        handler = _CMD_HANDLERS.get(data["command"])
+        if handler:
+            handler(data)
         
-        # Format 1: Direct WebSocket command (command/params structure)
-        if "command" in data and "params" in data:
-            print(f"[MQTT] Detected WebSocket command format: {data['command']}")
-            
-            # Handle simple on/off commands
-            if data["command"] == "led_on":
-                send_led_on()
-                print("[MQTT] Display turned ON")
-            
-            elif data["command"] == "led_off":
-                send_led_off()
-                print("[MQTT] Display turned OFF")
-            
-            # Extract text from params if it's a send_text command
-            elif data["command"] == "send_text" and data["params"]:
-                text_param = data["params"][0]
-                if text_param.startswith("text="):
-                    last_text = text_param[5:]  # Remove "text=" prefix
-                else:
-                    last_text = text_param
-                
-                print(f"[MQTT] Extracted text: {last_text}")
-                
-                # Send the command directly to WebSocket
-                ensure_server()
-                ws_send(data)  # Send the exact WebSocket command
-            
-        # Format 2: Simple parameter format (send_text, color, speed, etc.)
-        elif "send_text" in data:
-            last_text = data["send_text"]
-            print(f"[MQTT] Text to display: {last_text}")
-            
-            # Update all provided states
-            for k, v in data.items():
-                if k in current_states:
-                    current_states[k] = v
-                    print(f"[MQTT] Updated {k} = {v}")
-
-            # Build params for WebSocket command
-            params = [last_text]
-            param_keys = ["color", "speed", "animation", "font", "matrix_height"]
-            
-            for k in param_keys:
-                if k in data and data[k] is not None:
-                    params.append(f"{k}={data[k]}")
-                elif current_states.get(k) is not None:
-                    params.append(f"{k}={current_states[k]}")
-            
-            print(f"[MQTT] Sending text with params: {params}")
-            
-            # Ensure display is on and send text
-            ensure_server()
-            ws_send({"command": "send_text", "params": params})
-
-    # Handle individual topic sets (existing functionality)
-    elif key == "send_text":
-        last_text = data
-        if current_states.get("power"):
-            ensure_server()
-            ws_send({"command": "send_text", "params": [last_text]})
-
-    elif key == "power":
-        current_states["power"] = str(data).upper() in ("ON", "1", "TRUE")
+    # Format 2: Simple parameter format (send_text, color, speed, etc.)
+    elif "send_text" in data:
+        last_text = data["send_text"]
+        log.debug("[MQTT] Text to display: %s", last_text)
+        
+        # Update all provided states
+        snap = state.d
+        updates = {k: v for k, v in data.items() if k in snap}
+        state.update(updates)
+        log.debug("[MQTT] Updated %s", updates)
+
+        # Build options for WebSocket command from the merged state
+        snap = state.d
+        opts = {k: snap[k] for k in _PARAM_KEYS if snap.get(k) is not None}
+        
+        log.debug("[MQTT] Sending text with options: %s", opts)
+        
+        # Ensure display is on and send text
         ensure_server()
-        if current_states["power"]:
-            ws_send({"command": "send_text", "params": [" "]})  # Turn on with space
-        else:
-            ws_send({"command": "clear", "params": []})  # Turn off with clear
+        ws_send({"command": "send_text", "params": [last_text], "opts": opts})
 
+def _h_send_text_key(key, data):
+    global last_text
+    last_text = data
+    if state.d.get("power"):
+        ensure_server()
+        ws_send({"command": "send_text", "params": [last_text]})
+
+def _h_power(key, data):
+    power = str(data).upper() in ("ON", "1", "TRUE")
+    state.update({"power": power})
+    ensure_server()
+    if power:
+        ws_send({"command": "send_text", "params": [" "]})  # Turn on with space
+    else:
+        ws_send({"command": "clear", "params": []})  # Turn off with clear
+
+def _h_generic(key, data):
     # Handle other individual parameters
-    elif key in current_states:
-        current_states[key] = data
-        print(f"[MQTT] Updated {key} = {data}")
+    if key in state.d:
+        state.update({key: data})
+        log.debug("[MQTT] Updated %s = %s", key, data)
+
+_KEY_HANDLERS = {
+    "set": _h_set_json,
+    "send_text": _h_send_text_key,
+    "power": _h_power,
+}
+
+def handle_set_payload(key, payload):
+    # paho hands us bytes; orjson parses them directly, plain text is decoded
+    # only when it isn't JSON
+    try:
+        data = orjson.loads(payload)
+    except orjson.JSONDecodeError:
+        data = payload.decode("utf-8", "replace")
+    log.debug("[MQTT] Set %s -> %s", key, data)
+
+    _KEY_HANDLERS.get(key, _h_generic)(key, data)
 
     publish_states()
 
 
-def on_connect(client, userdata, flags, rc):
-    print("[MQTT] Connected, subscribing topics...")
+def on_connect(client, userdata, flags, reason_code, properties):
+    log.info("[MQTT] Connected, subscribing topics...")
     # Subscribe to base command topic and subtopics
     client.subscribe(CMD_TOPIC)
     client.subscribe(f"{CMD_TOPIC}/#")
     # Subscribe to individual topics
-    for t in TOPICS.values():
-        client.subscribe(t + "/set")
-    client.subscribe(TOPICS["send_text"])
-    publish_states()
+    for t in SET_TOPIC_MAP:
+        client.subscribe(t)
+    client.subscribe(SEND_TEXT_TOPIC)
+    publish_states(force=True)
 
 def on_message(client, userdata, msg):
     topic = msg.topic
     payload = msg.payload
-    print(f"[MQTT] Received {topic} -> {payload}")
+    log.debug("[MQTT] Received %s -> %s", topic, payload)
     
     # Extract the key from topic
     if topic == CMD_TOPIC:
         # This is the base command topic "ipixel/6554874a3e63/set"
         handle_set_payload("set", payload)
         return
-    elif topic.startswith(CMD_TOPIC + "/"):
+    elif topic.startswith(CMD_TOPIC_PREFIX):
         # Subtopics like "ipixel/6554874a3e63/set/send_text"
-        key = topic[len(CMD_TOPIC)+1:]
+        key = topic[CMD_TOPIC_PREFIX_LEN:]
         handle_set_payload(key, payload)
         return
         
     # Handle individual set topics (existing)
-    if topic == TOPICS["send_text"]:
+    if topic == SEND_TEXT_TOPIC:
         handle_set_payload("send_text", payload)
         return
         
-    for key, t in TOPICS.items():
-        if topic == t + "/set":
-            handle_set_payload(key, payload)
-            return
+    key = SET_TOPIC_MAP.get(topic)
+    if key is not None:
+        handle_set_payload(key, payload)
 
 # -----------------------------
 # MAIN
 # -----------------------------
 def mqtt_start():
     global client
-    client = mqtt.Client(client_id=f"ipixel_{DEVICE_ID_SAFE}")
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"ipixel_{DEVICE_ID_SAFE}")
     if MQTT_USER:
         client.username_pw_set(MQTT_USER, MQTT_PASS)
     client.on_connect = on_connect
     client.on_message = on_message
+    # State is fire-and-forget QoS 0; don't throttle or cap the outbound queue
+    client.max_inflight_messages_set(200)
+    client.max_queued_messages_set(0)
+    # Back off reconnects to the broker instead of retrying every second
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
     if SSL_ENABLED:
-        client.tls_set()
+        # Default CA verification with a TLS 1.2 floor (1.3 when the broker has it)
+        ctx = ssl.create_default_context()
+        ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+        client.tls_set_context(ctx)
     client.connect(MQTT_HOST, MQTT_PORT, 60)
+    threading.Thread(target=_ws_sender_loop, daemon=True).start()
+    threading.Thread(target=ws_receive_thread, daemon=True).start()
     client.loop_start()
-    print("[MQTT] Wrapper started")
+    log.info("[MQTT] Wrapper started")
 
 def periodic_tasks():
     ensure_server()
-    while True:
+    while not _stop.is_set():
         publish_states()
-        time.sleep(10)
+        _stop.wait(10)
 
 if __name__ == "__main__":
-    print("Starting iPixel MQTT Wrapper...")
+    log.info("Starting iPixel MQTT Wrapper...")
+    signal.signal(signal.SIGINT, lambda *_: _stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: _stop.set())
     mqtt_start()
-    threading.Thread(target=periodic_tasks, daemon=True).start()
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        print("Exiting...")
-        client.loop_stop()
-        client.disconnect()
+    periodic = threading.Thread(target=periodic_tasks, daemon=True)
+    periodic.start()
+    # Sleep until a signal arrives instead of waking up every second
+    _stop.wait()
+    log.info("Exiting...")
+    periodic.join(timeout=5)
+    client.disconnect()
+    client.loop_stop()
+    stop_server()